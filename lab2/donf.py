@@ -18,23 +18,49 @@ inference for testing:
                         (otherwise, only filename)
     output file: test_inf(_conf).csv
 
+multi-gpu training (DDP), with gradient accumulation over 4 microbatches:
+    torchrun --nproc_per_node=2 donf.py new -e 10 -b 8 --accumulation-steps=4
+    --batch-size is per process
+
+decode all the images once into RAM before training (for datasets fitting in memory), once
+per node under torchrun:
+    python donf.py new -e 10 -b 8 --preload
+
+decode the jpegs on the gpu (nvjpeg), also for inference. Train and evaluate a model with the
+same setting, the resize on the gpu is close to but not the same as the one on the cpu:
+    python donf.py new -e 10 -b 8 --gpu-decode
+
+train from WebDataset shards written by pack_shards.py (see there), under torchrun the valid
+shards are split over the processes, unless there are fewer shards than processes (e.g. a single
+~1 GB valid shard), then every process evaluates all of them:
+    python donf.py new -e 10 -b 8 --shards=shards
+
+omit --batch-size to use half the largest power of 2 for which a bare training step fits in
+memory (headroom for the prefetched batch, DDP and compile), searched once per variant, gpu,
+amp, amp_dtype and channels_last and cached in batch_size.json:
+    python donf.py new -e 10
+
 inference for submission:
     python donf.py inference --batch-size=? --weights=/path/to/checkpoints --test-dir=/path/to/testdir
     output file: submission.csv
 """
 import os
+import json
 import argparse
 import numpy as np
 import pandas as pd
-from torchvision import transforms
-from torchvision.transforms import InterpolationMode
+import torch
+from torch import distributed as dist
 from dotenv import load_dotenv
-from imgclf.dataset import Dataset
+from imgclf.base.distributed import is_distributed, is_main_process, get_world_size
+from imgclf.dataset import Dataset, ShardDataset
 from nfnet.config import NfnetConfig
 from nfnet.nfnet_model_utils import NfnetModelUtils
 
 load_dotenv(".env")
 SET_PATH = os.path.abspath("set.csv")
+BATCH_SIZE_PATH = os.path.abspath("batch_size.json")
+BATCH_SIZE_VERSION = 2 # bump when find_max_batch_size changes, to search again
 VAR = os.environ["VARIANT"]
 DATASET_ROOT = os.path.abspath(os.environ["DATASET_ROOT"])
 PRETRAINED_PATH = os.path.abspath(os.path.join(os.environ["PRETRAINED_ROOT"], f"{VAR}_haiku.npz"))
@@ -47,37 +73,44 @@ IMG_SIZE = {
 # CATS = ["banana", "bareland", "carrot", "corn", "dragonfruit", "garlic", "guava", "inundated", "peanut", "pineapple", "pumpkin", "rice", "soybean", "sugarcane", "tomato"]
 CATS = ["banana", "bareland", "carrot", "corn", "dragonfruit", "garlic", "guava", "bareland", "peanut", "pineapple", "pumpkin", "rice", "soybean", "sugarcane", "tomato"]
 
-TRAIN_TRANSFORM = transforms.Compose([
-    transforms.Resize(IMG_SIZE[VAR], InterpolationMode.BICUBIC),
-    transforms.RandomHorizontalFlip(),
-    transforms.ToTensor(),
-])
-EVAL_TRANSFORM = transforms.Compose([
-    transforms.Resize(IMG_SIZE[VAR], InterpolationMode.BICUBIC),
-    transforms.ToTensor(),
-])
-
 def main():
     assert os.path.isdir(DATASET_ROOT), f"cannot find dir {DATASET_ROOT}, pls checkout .env"
     # assert os.path.isfile(PRETRAINED_PATH), "cannot find pretrained weights' path, pls checkout .env"
 
-    mode, batch_size, epochs, weights, confidence, test_dir, full_path = parse()
+    (mode, batch_size, epochs, weights, confidence, test_dir, full_path,
+        accumulation_steps, preload, shards, gpu_decode) = parse()
+
+    # cudnn.benchmark is turned on by NfnetModelUtils.init_model
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     if mode != "inference":
-        train(mode, batch_size, epochs, weights)
+        init_distributed()
+    if batch_size is None:
+        batch_size = find_batch_size()
+
+    if mode != "inference":
+        train(mode, batch_size, epochs, weights, accumulation_steps, preload, shards,
+                gpu_decode)
     else:
-        inference(batch_size, weights, confidence, test_dir, full_path)
+        inference(batch_size, weights, confidence, test_dir, full_path, gpu_decode)
     return
 
 
 def parse():
     parser = argparse.ArgumentParser()
     parser.add_argument("command", type=str, help="'new', 'last', 'inference'", metavar="command")
-    parser.add_argument("-b", "--batch-size", required=True, type=int, metavar="<batch size>")
+    parser.add_argument("-b", "--batch-size", required=False, type=int, metavar="<batch size>")
     parser.add_argument("-e", "--epochs", required=False, type=int, metavar="<num of epochs>")
     parser.add_argument("-w", "--weights", required=False, metavar="<path to checkpoint>")
     parser.add_argument("-c", "--confidence", action="store_true")
     parser.add_argument("--full-path", action="store_true")
     parser.add_argument("--test-dir", required=False, type=str, metavar="<path to test dir>")
+    parser.add_argument("-a", "--accumulation-steps", required=False, type=int, default=1,
+                        metavar="<num of microbatches per step>")
+    parser.add_argument("--preload", action="store_true")
+    parser.add_argument("--shards", required=False, type=str, metavar="<path to shards dir>")
+    parser.add_argument("--gpu-decode", action="store_true")
     args = parser.parse_args()
 
     assert args.command in ["new", "last", "inference"]
@@ -90,15 +123,66 @@ def parse():
     
     return (
         args.command, args.batch_size, args.epochs,
-        args.weights, args.confidence, args.test_dir, args.full_path
+        args.weights, args.confidence, args.test_dir, args.full_path,
+        args.accumulation_steps, args.preload, args.shards, args.gpu_decode,
     )
 
-def get_config(batch_size):
+def init_distributed():
+    """init the process group of DDP when launched by torchrun"""
+    if "LOCAL_RANK" not in os.environ:
+        return
+    torch.cuda.set_device(int(os.environ["LOCAL_RANK"]))
+    dist.init_process_group("nccl")
+    return
+
+def get_base_config():
     config = NfnetConfig(variant=VAR, log_dir=os.environ["LOG_ROOT"])
+    config.img_size = IMG_SIZE[VAR]
+    config.num_class = len(CATS)
+    if is_distributed():
+        config.device = torch.device("cuda", int(os.environ["LOCAL_RANK"]))
+    return config
+
+def find_batch_size():
+    """batch size from `NfnetModelUtils.find_max_batch_size`, searched only once by rank 0
+    and broadcast to the other processes of DDP (if any)"""
+    batch_size = [None]
+    if is_main_process():
+        batch_size[0] = search_batch_size()
+    if is_distributed():
+        dist.broadcast_object_list(batch_size, src=0)
+    print(f"batch size: {batch_size[0]}")
+    return batch_size[0]
+
+def search_batch_size():
+    """see `find_batch_size`, cached in batch_size.json for everything the result depends on"""
+    config = get_base_config()
+    key = (
+        f"v{BATCH_SIZE_VERSION}/{VAR}/{torch.cuda.get_device_name(config.device)}"
+        f"/amp={config.amp}/{config.amp_dtype}/channels_last={config.channels_last}"
+    )
+    cache = {}
+    if os.path.isfile(BATCH_SIZE_PATH):
+        with open(BATCH_SIZE_PATH, "r", encoding="utf-8") as fin:
+            cache = json.load(fin)
+
+    if key not in cache:
+        batch_size = NfnetModelUtils.find_max_batch_size(config)
+        assert batch_size is not None, "not enough memory for the smallest batch size"
+        cache[key] = batch_size
+        with open(BATCH_SIZE_PATH, "w", encoding="utf-8") as fout:
+            json.dump(cache, fout, indent=4)
+    return cache[key]
+
+def get_config(batch_size, accumulation_steps: int = 1, gpu_decode: bool = False):
+    config = get_base_config()
     config.batch_size["train"] = batch_size
     config.batch_size["eval"] = batch_size
-    config.num_class = len(CATS)
-    config.learning_rate = 0.1 * batch_size / 256
+    config.accumulation_steps = accumulation_steps
+    config.gpu_decode = gpu_decode
+    world_size = get_world_size()
+    # scale with the effective batch size of a step
+    config.learning_rate = 0.1 * batch_size * world_size * accumulation_steps / 256
     config.display()
     return config
 
@@ -126,14 +210,21 @@ def get_infset(test_dir: str, config: NfnetConfig):
     assert os.path.isdir(test_dir)
     images = [os.path.join(test_dir, file) for file in os.listdir(test_dir)]
     df = pd.DataFrame({"img": images})
-    return Dataset(df, config, mode="inference", transform=EVAL_TRANSFORM)
+    return Dataset(df, config, mode="inference")
 
 
-def train(mode: str, batch_size, epochs, weight_path: str):
-    config = get_config(batch_size)
-    df = get_df()
-    train_set, valid_set = Dataset.train_test_split(df, train_ratio=0.8, config=config, 
-                        transforms_f=[TRAIN_TRANSFORM, EVAL_TRANSFORM])
+def train(mode: str, batch_size, epochs, weight_path: str, accumulation_steps: int = 1,
+            preload: bool = False, shards: str = None, gpu_decode: bool = False):
+    config = get_config(batch_size, accumulation_steps, gpu_decode)
+    if shards is not None:
+        train_set = ShardDataset(os.path.join(shards, "train"), config, mode="train")
+        valid_set = ShardDataset(os.path.join(shards, "valid"), config, mode="eval")
+    else:
+        df = get_df()
+        train_set, valid_set = Dataset.train_test_split(df, train_ratio=0.8, config=config)
+        if preload:
+            train_set.preload()
+            valid_set.preload()
 
     if mode == "new":
         utils = NfnetModelUtils.start_new_training_from_pretrained(PRETRAINED_PATH, config)
@@ -148,14 +239,13 @@ def train(mode: str, batch_size, epochs, weight_path: str):
     return
 
 def inference(batch_size, weight_path: str, confidence: bool,
-                test_dir: str = None, full_path: bool = None):
-    config = get_config(batch_size)
+                test_dir: str = None, full_path: bool = None, gpu_decode: bool = False):
+    config = get_config(batch_size, gpu_decode=gpu_decode)
     
     if test_dir is None:
         df = get_df()
-        _, inf_set = Dataset.train_test_split(df, train_ratio=0.99, config=config, 
-                            transforms_f=[TRAIN_TRANSFORM, EVAL_TRANSFORM])
-        inf_set = Dataset(inf_set.df, config, mode="inference", transform=EVAL_TRANSFORM)
+        _, inf_set = Dataset.train_test_split(df, train_ratio=0.99, config=config)
+        inf_set = Dataset(inf_set.df, config, mode="inference")
     else:
         inf_set  = get_infset(test_dir, config)
 
@@ -0,0 +1,24 @@
+"""state of the process group of DDP (e.g. launched by torchrun), shared by the datasets and
+the model utils so that they cannot disagree about it"""
+import os
+from torch import distributed as dist
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+def is_main_process() -> bool:
+    """rank 0 of DDP, or the only process"""
+    return get_rank() == 0
+
+def get_rank() -> int:
+    """rank of DDP, 0 if not distributed"""
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size() -> int:
+    """number of processes of DDP, 1 if not distributed"""
+    return dist.get_world_size() if is_distributed() else 1
+
+def get_local_rank() -> int:
+    """rank of DDP within the node (LOCAL_RANK set by torchrun), 0 if not distributed"""
+    return int(os.environ.get("LOCAL_RANK", 0)) if is_distributed() else 0
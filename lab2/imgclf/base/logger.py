@@ -80,3 +80,24 @@ class Logger:
         self._c_logger.warning(msg)
         self._f_logger.warning(msg)
         return
+
+
+class NullLogger(Logger):
+    """Logger discarding everything, e.g. for the processes other than rank 0 of DDP"""
+
+    def __init__(self): # pylint: disable=super-init-not-called
+        return
+
+    @property
+    def file(self):
+        return self
+
+    @property
+    def console(self):
+        return self
+
+    def log(self, msg: str):
+        return
+
+    def warning(self, msg: str):
+        return
@@ -74,16 +74,25 @@ class BaseModelUtils:
     def _get_criterion(config: ModelUtilsConfig) -> nn.Module:
         raise NotImplementedError
 
+    @staticmethod
+    def _new_root(config: ModelUtilsConfig) -> str:
+        """create the dir for the history, log and checkpoints of a new training"""
+        root = os.path.join(config.log_dir, formatted_now())
+        os.makedirs(root, exist_ok=True)
+        return root
+
+    @staticmethod
+    def _get_logger(root: str) -> Logger:
+        return Logger(root)
+
     @classmethod
     def start_new_training(cls, model: nn.Module, config: ModelUtilsConfig):
         
         optimizer = cls._get_optimizer(model, config)
         # init for history and log
-        time_str = formatted_now()
-        root = os.path.join(config.log_dir, time_str)
-        os.makedirs(root, exist_ok=True)
+        root = cls._new_root(config)
         history_utils = HistoryUtils(root=root)
-        logger = Logger(root)
+        logger = cls._get_logger(root)
         
         return cls(
             model = model,
@@ -109,7 +118,9 @@ class BaseModelUtils:
 
         assert os.path.isfile(checkpoint_path)
 
-        tem = torch.load(checkpoint_path)
+        # the tensors go to the device of each process by `model.to` and `load_state_dict`,
+        # instead of all onto the device the checkpoint was saved from
+        tem = torch.load(checkpoint_path, map_location="cpu")
         checkpoint = ModelStates(**tem)
         config = config or ModelUtilsConfig(**checkpoint.config)
 
@@ -119,7 +130,7 @@ class BaseModelUtils:
         optimizer.load_state_dict(checkpoint.optimizer_state_dict)
         
         root = os.path.dirname(checkpoint_path)
-        logger = Logger(root)
+        logger = cls._get_logger(root)
         start_epoch = checkpoint.start_epoch
         history_utils = HistoryUtils.load_history(root, start_epoch, logger)
         logger.log(f"Checkpoint {os.path.basename(checkpoint_path)} is loaded.")
@@ -210,6 +221,10 @@ class BaseModelUtils:
         self.logger.log(f"Checkpoint: {name} is saved.")
         self.history_utils.history["checkpoints"][cur_epoch + 1] = name
         return name
+
+    def _log_history(self, stat: Stat) -> str:
+        """see `HistoryUtils.log_history`"""
+        return self.history_utils.log_history(stat)
     
 
     def _train_epoch(self, train_dataset: Dataset) -> Tuple[float, float]:
@@ -296,7 +311,7 @@ class BaseModelUtils:
                     self._save(epoch, stat)
 
             if epoch != epochs - 1:
-                self.history_utils.log_history(stat)
+                self._log_history(stat)
 
         self.logger.log(f"Training is finish for epochs: {epochs}")
         if testset is not None:
@@ -304,7 +319,7 @@ class BaseModelUtils:
             stat.test_loss = test_loss
             stat.test_acc = test_acc
             stat.display()
-        return self.history_utils.log_history(stat)
+        return self._log_history(stat)
     
     
     def plot_history(self, loss_uplimit: float = None, acc_autoscale: bool = False,
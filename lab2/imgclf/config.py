@@ -33,6 +33,13 @@ class Config(ModelConfig, DatasetConfig, ModelUtilsConfig):
         "eval": 256,
     }
 
+    img_size = (224, 224)
+    """(h, w) of the images fed to the model"""
+
+    gpu_decode: bool = False
+    """decode (nvjpeg) and resize the images on the device instead of in the DataLoader's
+    workers"""
+
 
     ## ------------ ModelUtilsConfig ----------------------
 
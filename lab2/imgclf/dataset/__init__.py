@@ -1 +1,3 @@
-from .dataset import Dataset
+from .dataset import Dataset, fast_collate, gpu_collate_fn, transforms
+from .prefetcher import CUDAPrefetcher
+from .shard_dataset import ShardDataset
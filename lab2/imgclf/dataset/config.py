@@ -16,3 +16,10 @@ class DatasetConfig(BaseConfig):
         "train": UNIMPLEMENTED,
         "eval": UNIMPLEMENTED,
     }
+
+    img_size = UNIMPLEMENTED
+    """(h, w) of the images fed to the model"""
+
+    gpu_decode: bool = UNIMPLEMENTED
+    """decode (nvjpeg) and resize the images on the device instead of in the DataLoader's
+    workers"""
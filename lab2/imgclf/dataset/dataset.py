@@ -1,36 +1,98 @@
 # required before pythonV3.10
 from __future__ import annotations
-from typing import Tuple
+import os
+import uuid
+import tempfile
+import warnings
+from typing import List, Tuple
 
 try:
     from typing import Literal
 except ImportError:
     from typing_extensions import Literal
 
-from torchvision import transforms
-from torchvision.transforms import InterpolationMode
-from torch.utils.data import DataLoader
+import torch
+from torch import Tensor
+from torch import distributed as dist
+from torch.utils.data import DataLoader, DistributedSampler
 from torch.utils.data import Dataset as TorchDataset
+from torchvision.io import read_file
+from torchvision.transforms import InterpolationMode
+try:
+    from torchvision.transforms import v2 as transforms
+except ImportError: # for torchvision < 0.15, whose transforms also take tensors
+    from torchvision import transforms
 import pandas as pd
 import numpy as np
 from PIL import Image
+from tqdm import tqdm
 from sklearn.model_selection import train_test_split
+from ..base.distributed import (
+    is_distributed, is_main_process, get_rank, get_local_rank, get_world_size
+)
 from .config import DatasetConfig
+from .prefetcher import Prefetchable
 
 
-class Dataset(TorchDataset):
-    """Dataset for image classification task"""
+def fast_collate(batch: List[Tuple[Tensor, int]]) -> Tuple[Tensor, Tensor]:
+    """stack uint8 HWC images into a uint8 N x H x W x C batch without any float conversion,
+    which is left to `CUDAPrefetcher` on the device.
+    """
+    targets = torch.tensor([target for _, target in batch], dtype=torch.int64)
+    h, w, c = batch[0][0].shape
+    tensor = torch.zeros((len(batch), h, w, c), dtype=torch.uint8)
+    for i, (img, _) in enumerate(batch):
+        tensor[i].copy_(img)
+    return tensor, targets
+
+
+def gpu_collate_fn(batch: List[Tuple[Tensor, int]]) -> Tuple[List[Tensor], Tensor]:
+    """keep the encoded images as a list, they are decoded (and resized) on the device
+    by `CUDAPrefetcher`.
+    """
+    targets = torch.tensor([target for _, target in batch], dtype=torch.int64)
+    return [data for data, _ in batch], targets
+
+
+def open_image(fp, size: Tuple[int, int]) -> Image.Image:
+    """open an image as RGB, letting libjpeg downscale it by 1/2, 1/4 or 1/8 while decoding
+    (never below `size`), no-op for other formats.
+
+    Args:
+        fp: path or file object, as for `PIL.Image.open`
+        size (Tuple[int, int]): (h, w) the image is going to be resized to
+    """
+    img = Image.open(fp)
+    # PIL takes (w, h)
+    img.draft("RGB", tuple(reversed(size)))
+    return img.convert("RGB")
+
+
+def load_resized(fp, size: Tuple[int, int]) -> Tensor:
+    """`open_image` then resize it (bicubic) to `size`
+
+    Returns:
+        Tensor: uint8 H x W x C
+    """
+    h, w = size
+    img = open_image(fp, size).resize((w, h), Image.BICUBIC)
+    return torch.from_numpy(np.asarray(img))
+
+
+class Dataset(TorchDataset, Prefetchable):
+    """Dataset for image classification task
+
+    Images are yielded as uint8 H x W x C tensors; the conversion to float is done on the
+    device by `CUDAPrefetcher` (see `Dataset.prefetch`). Transforms take a PIL image and have
+    to return a uint8 C x H x W tensor (i.e. `PILToTensor` instead of `ToTensor`).
+
+    With `config.gpu_decode`, the raw file content is yielded instead and both decoding and
+    the transforms (resize, random flip for mode `train`) are done on the device.
+
+    After `Dataset.preload`, images are read from an in-memory cache instead, with the
+    random flip for mode `train` done on the device as well.
+    """
 
-    TRAIN_TRANSFORM = transforms.Compose([
-        transforms.Resize((224, 224), InterpolationMode.BICUBIC),
-        transforms.RandomHorizontalFlip(),
-        transforms.ToTensor(),
-    ])
-    EVAL_TRANSFORM = transforms.Compose([
-        transforms.Resize((224, 224), InterpolationMode.BICUBIC),
-        transforms.ToTensor(),
-    ])
-    
     def __init__(self, df: pd.DataFrame, config: DatasetConfig,
         mode: Literal["train", "eval", "inference"] = "train",
         transform: transforms.Compose = None):
@@ -61,14 +123,33 @@ class Dataset(TorchDataset):
 
         self.mode = mode
         self.df = df
+        # plain arrays for __getitem__, indexing them is much cheaper than df.iloc
+        self._img_paths = df["img"].to_numpy()
+        self._labels = df["label"].to_numpy() if mode != "inference" else None
+        self._default_transform = transform is None
         if transform is None:
-            self.transform = self.TRAIN_TRANSFORM if mode == "train" else self.EVAL_TRANSFORM
+            self.transform = self.default_transform(mode, config.img_size)
         else:
             self.transform = transform
         
         self.config = config
+        self._epoch = 0
+        self._cache: Tensor = None
         return
     
+    @staticmethod
+    def default_transform(mode: Literal["train", "eval", "inference"],
+                            img_size: Tuple[int, int]) -> transforms.Compose:
+        """`PILToTensor` and bicubic resize to `img_size` (h, w), plus a random horizontal flip
+        for mode `train`"""
+        steps = [
+            transforms.PILToTensor(),
+            transforms.Resize(tuple(img_size), InterpolationMode.BICUBIC, antialias=True),
+        ]
+        if mode == "train":
+            steps.append(transforms.RandomHorizontalFlip())
+        return transforms.Compose(steps)
+
     @classmethod
     def train_test_split(
             cls,
@@ -136,19 +217,79 @@ class Dataset(TorchDataset):
         # 2. Preprocess the data (torchvision.Transform).
         # 3. Return the data (e.g. image and label)
         # --------------------------------------------
+        imgpath = self._img_paths[index]
         if self.mode != "inference":
-            imgpath, label = self.df.iloc[index]
-        else:
-            imgpath = self.df["img"].iloc[index]
-        
-        img = Image.open(imgpath).convert("RGB")
-        img = self.transform(img)
+            label = int(self._labels[index])
+
+        if self._cache is not None:
+            return self._cache[index], (label if self.mode != "inference" else index)
+
+        if self.config.gpu_decode:
+            data = read_file(imgpath)
+            return data, (label if self.mode != "inference" else index)
+
+        img = open_image(imgpath, self.config.img_size)
+        img: Tensor = self.transform(img)
+        # C x H x W -> H x W x C, as the cache and `fast_collate`
+        img = img.permute(1, 2, 0)
 
         if self.mode != "inference":
             return img, label
 
         return img, index
         
+    PRELOAD_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    """dir of the file backing the cache of `preload` under DDP, None for the temp dir"""
+
+    def preload(self):
+        """decode and resize all the images once into a uint8 N x H x W x C tensor in shared
+        memory, which the DataLoader's workers index instead of reading files every epoch.
+        Only for datasets fitting in RAM (N * H * W * 3 bytes). Under DDP, the images are
+        decoded once per node by its local rank 0 and the tensor is mapped by all its processes.
+
+        Only the resize to `config.img_size` and the random flip (done on the device) of the
+        default transforms are applied, any other transform is ignored.
+
+        Returns:
+            self
+        """
+        if not self._default_transform:
+            warnings.warn("preload ignores the given transform, only resizing to img_size and "
+                            "randomly flipping for mode train")
+
+        h, w = self.config.img_size
+        shape = (len(self), h, w, 3)
+        if not is_distributed():
+            self._cache = self._decode_all(
+                torch.empty(shape, dtype=torch.uint8).share_memory_()
+            )
+            return self
+
+        # a single name for all the nodes, each of them writes its own file
+        name = [f"preload-{uuid.uuid4().hex}" if is_main_process() else None]
+        dist.broadcast_object_list(name, src=0)
+        path = os.path.join(self.PRELOAD_DIR or tempfile.gettempdir(), name[0])
+
+        if get_local_rank() == 0:
+            cache = np.memmap(path, dtype=np.uint8, mode="w+", shape=shape)
+            self._decode_all(torch.from_numpy(cache))
+            cache.flush()
+        dist.barrier()
+        if get_local_rank() != 0:
+            cache = np.memmap(path, dtype=np.uint8, mode="r+", shape=shape)
+        dist.barrier()
+        if get_local_rank() == 0:
+            # every process has mapped it, the mappings outlive the file
+            os.remove(path)
+
+        self._cache = torch.from_numpy(cache)
+        return self
+
+    def _decode_all(self, cache: Tensor) -> Tensor:
+        for i, imgpath in enumerate(tqdm(self._img_paths, desc="preload")):
+            cache[i].copy_(load_resized(imgpath, self.config.img_size))
+        return cache
+
     def __len__(self):
         # --------------------------------------------
         # Indicate the total size of the dataset
@@ -161,11 +302,31 @@ class Dataset(TorchDataset):
             mode = "eval"
         else:
             mode = self.mode
+        sampler = None
+        if self.mode == "train" and is_distributed():
+            # shard over the processes of DDP, reshuffled every epoch
+            sampler = DistributedSampler(self, shuffle=True)
+            sampler.set_epoch(self._epoch)
+            self._epoch += 1
+        elif self.mode == "eval" and is_distributed():
+            # every sample exactly once, unlike DistributedSampler which pads with duplicates
+            # to give all the processes the same number of samples
+            sampler = range(get_rank(), len(self), get_world_size())
+
         return DataLoader(
             self,
             batch_size = self.config.batch_size[mode],
-            shuffle = self.mode == "train",
+            shuffle = sampler is None and self.mode == "train",
+            sampler = sampler,
             num_workers = self.config.num_workers,
             persistent_workers = self.config.persistent_workers,
             pin_memory = self.config.pin_memory,
+            collate_fn = (
+                gpu_collate_fn if self.config.gpu_decode and self._cache is None
+                else fast_collate
+            ),
         )
+
+    @property
+    def random_flip_on_device(self) -> bool:
+        return self.mode == "train" and (self.config.gpu_decode or self._cache is not None)
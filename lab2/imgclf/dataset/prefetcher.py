@@ -0,0 +1,158 @@
+from typing import Iterator, List, Sequence, Tuple, Union
+import torch
+from torch import Tensor
+from torch.nn import functional as F
+from torch.utils.data import DataLoader
+from torchvision.io import decode_jpeg, decode_image, ImageReadMode
+from .config import DatasetConfig
+
+
+class CUDAPrefetcher:
+    """Wrap a DataLoader yielding uint8 NHWC batches (see `fast_collate`) or lists of encoded
+    images (see `gpu_collate_fn`), copy the next batch to the device on a side stream and
+    finish the preprocessing there.
+
+    Yields:
+        inputs (float32 NCHW in [0, 1], or normalized if mean/std given), targets
+    """
+
+    def __init__(
+            self,
+            loader: DataLoader,
+            device: torch.device,
+            size: Tuple[int, int] = None,
+            mean: Sequence[float] = None,
+            std: Sequence[float] = None,
+            random_flip: bool = False,
+            memory_format: torch.memory_format = None,
+        ):
+        """
+        Args:
+            loader (DataLoader): loader using `fast_collate` or `gpu_collate_fn`
+            device (torch.device): device to prefetch to
+            size (Tuple[int, int]): (h, w) to resize to on device, skipped if the batch already
+                has the size. Required for encoded batches. Defaults to None (no resizing).
+            mean, std (Sequence[float]): per channel normalization. Defaults to None.
+            random_flip (bool): random horizontal flip on device. Defaults to False.
+            memory_format (torch.memory_format): memory format of the yielded inputs.
+                Defaults to None (as is, which is already channels_last for uint8 NHWC batches).
+        """
+        self.loader = loader
+        self.device = torch.device(device)
+        self.size = tuple(size) if size is not None else None
+        self.random_flip = random_flip
+        self.memory_format = memory_format
+        self.use_cuda = self.device.type == "cuda"
+        self.stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+
+        if mean is not None and std is not None:
+            self.mean = torch.tensor(mean, device=self.device).mul_(255).view(1, 3, 1, 1)
+            self.std = torch.tensor(std, device=self.device).mul_(255).view(1, 3, 1, 1)
+        else:
+            self.mean = self.std = None
+        return
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _resize(self, inputs: Tensor) -> Tensor:
+        if self.size is None or tuple(inputs.shape[-2:]) == self.size:
+            return inputs
+        # bicubic alone aliases when shrinking much, average down to at most twice the size
+        # first, which is close to the draft and antialiased resize of the cpu path
+        h, w = inputs.shape[-2:]
+        reduced = (min(h, 2 * self.size[0]), min(w, 2 * self.size[1]))
+        if reduced != (h, w):
+            inputs = F.interpolate(inputs, size=reduced, mode="area")
+        inputs = F.interpolate(inputs, size=self.size, mode="bicubic", align_corners=False)
+        inputs.clamp_(0, 255)
+        return inputs
+
+    def _decode_one(self, encoded: Tensor) -> Tensor:
+        if self.use_cuda:
+            try:
+                return decode_jpeg(encoded, mode=ImageReadMode.RGB, device=self.device)
+            except RuntimeError:
+                # not a jpeg or unsupported by nvjpeg, fallback to cpu
+                pass
+        img = decode_image(encoded, mode=ImageReadMode.RGB)
+        return img.to(self.device, non_blocking=True)
+
+    def _decode(self, batch: List[Tensor]) -> Tensor:
+        assert self.size is not None, "size is required for batches of encoded images"
+        images = [
+            self._resize(self._decode_one(encoded).unsqueeze(0).float()) for encoded in batch
+        ]
+        return torch.cat(images)
+
+    def _preprocess(self, inputs: Union[Tensor, List[Tensor]]) -> Tensor:
+        if isinstance(inputs, (list, tuple)):
+            inputs = self._decode(inputs)
+        else:
+            inputs = inputs.to(self.device, non_blocking=True)
+            # N x H x W x C -> N x C x H x W
+            inputs = self._resize(inputs.permute(0, 3, 1, 2).float())
+
+        if self.random_flip:
+            flip = torch.rand(inputs.size(0), device=self.device) < 0.5
+            inputs = torch.where(flip.view(-1, 1, 1, 1), inputs.flip(-1), inputs)
+
+        if self.mean is not None:
+            inputs.sub_(self.mean).div_(self.std)
+        else:
+            inputs.div_(255)
+
+        if self.memory_format is not None:
+            inputs = inputs.contiguous(memory_format=self.memory_format)
+        return inputs
+
+    def _preload(self, loader_iter: Iterator):
+        try:
+            inputs, targets = next(loader_iter)
+        except StopIteration:
+            return None
+
+        if not self.use_cuda:
+            return self._preprocess(inputs), targets.to(self.device)
+
+        with torch.cuda.stream(self.stream):
+            targets = targets.to(self.device, non_blocking=True)
+            inputs = self._preprocess(inputs)
+        return inputs, targets
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        batch = self._preload(loader_iter)
+        while batch is not None:
+            if self.use_cuda:
+                torch.cuda.current_stream(self.device).wait_stream(self.stream)
+                # tensors created on the side stream are about to be used on the current one
+                for tensor in batch:
+                    tensor.record_stream(torch.cuda.current_stream(self.device))
+            inputs, targets = batch
+            batch = self._preload(loader_iter)
+            yield inputs, targets
+        return
+
+
+class Prefetchable:
+    """mixin for the datasets whose `data_loader` yields batches `CUDAPrefetcher` takes"""
+
+    config: DatasetConfig
+    data_loader: DataLoader
+
+    @property
+    def random_flip_on_device(self) -> bool:
+        """whether the random flip is left to `CUDAPrefetcher` instead of the transforms"""
+        raise NotImplementedError
+
+    def prefetch(self, device: torch.device,
+                    memory_format: torch.memory_format = None) -> CUDAPrefetcher:
+        """iterate over `data_loader` with batches preprocessed on `device`"""
+        return CUDAPrefetcher(
+            self.data_loader,
+            device,
+            size = self.config.img_size,
+            random_flip = self.random_flip_on_device,
+            memory_format = memory_format,
+        )
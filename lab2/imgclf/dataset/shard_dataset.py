@@ -0,0 +1,132 @@
+# required before pythonV3.10
+from __future__ import annotations
+import os
+import io
+import json
+import math
+from typing import List, Tuple
+
+try:
+    from typing import Literal
+except ImportError:
+    from typing_extensions import Literal
+
+from torch import Tensor
+from torch.utils.data import DataLoader
+from ..base.distributed import get_rank, get_world_size
+from .config import DatasetConfig
+from .dataset import fast_collate, load_resized
+from .prefetcher import Prefetchable
+
+INDEX_NAME = "index.json"
+"""index of the shards in a shards dir,
+{"shards": [<tar name>, ...], "sizes": [<num of samples>, ...], "num_samples": int}
+("sizes" is missing from the indexes written by older `pack_shards.py`)"""
+
+
+class ShardDataset(Prefetchable):
+    """Dataset for image classification task reading WebDataset tar shards written by
+    `pack_shards.py` (`<key>.jpg` + `<key>.cls` per sample) sequentially, instead of opening a
+    file per sample. Requires `webdataset`.
+
+    Batches are the same as `Dataset`'s (uint8 N x H x W x C, see `fast_collate`), with the
+    random flip for mode `train` done on the device. Mode `inference` is not supported since
+    the samples come in shard order.
+
+    In mode `train`, every worker of every process of DDP draws shards with replacement and
+    yields the same number of full batches, about `len(self)` samples per epoch in total, so
+    that all the processes run the same number of steps. In mode `eval`, the shards are split
+    over the processes of DDP like `Dataset` does with the samples, unless there are fewer
+    shards than processes, in which case every process reads all of them.
+    """
+
+    def __init__(self, root: str, config: DatasetConfig,
+        mode: Literal["train", "eval"] = "train"):
+        """
+        Args:
+            root (str): dir containing the shards and their index.json
+            mode: Defaults to "train".
+        """
+        assert mode in ["train", "eval"], f"unknown type of mode: {mode}"
+
+        with open(os.path.join(root, INDEX_NAME), "r", encoding="utf-8") as fin:
+            index = json.load(fin)
+
+        self.urls = [os.path.join(root, name) for name in index["shards"]]
+        self.sizes: List[int] = index.get("sizes")
+        self.num_samples: int = index["num_samples"]
+        self.mode = mode
+        self.config = config
+        return
+
+    def _decode(self, sample: dict) -> Tuple[Tensor, int]:
+        img = load_resized(io.BytesIO(sample["jpg"]), self.config.img_size)
+        return img, int(sample["cls"])
+
+    def __len__(self):
+        return self.num_samples
+
+    @property
+    def data_loader(self):
+        import webdataset as wds # pylint: disable=import-outside-toplevel
+
+        batch_size = self.config.batch_size[self.mode]
+        if self.mode == "train":
+            world_size = get_world_size()
+            num_workers = max(self.config.num_workers, 1)
+            num_batches = self.num_samples // (world_size * num_workers * batch_size)
+            assert num_batches > 0, "less samples than a batch per worker and process"
+
+            dataset = (
+                wds.WebDataset(self.urls, resampled=True)
+                .shuffle(1000)
+                .map(self._decode)
+                .batched(batch_size, collation_fn=fast_collate, partial=False)
+                .with_epoch(num_batches)
+                .with_length(num_batches * num_workers)
+            )
+            return DataLoader(
+                dataset,
+                batch_size = None,
+                num_workers = self.config.num_workers,
+                persistent_workers = self.config.persistent_workers,
+                pin_memory = self.config.pin_memory,
+            )
+
+        urls, num_samples = self._eval_shards()
+        dataset = wds.WebDataset(urls, shardshuffle=False, nodesplitter=_as_split)
+        loader = wds.WebLoader(
+            dataset.map(self._decode),
+            batch_size = None,
+            num_workers = min(self.config.num_workers, len(urls)),
+            persistent_workers = self.config.persistent_workers,
+            pin_memory = self.config.pin_memory,
+        )
+        # batched in the main process, so that only the last batch is partial
+        return (
+            loader.batched(batch_size, collation_fn=fast_collate)
+            .with_length(math.ceil(num_samples / batch_size))
+        )
+
+    def _eval_shards(self) -> Tuple[List[str], int]:
+        """shards read by this process in mode `eval` and their number of samples
+
+        Eval runs without collectives and `_reduce` sums the number of samples, so the shares
+        may be uneven. When every process reads all the shards (fewer shards than processes,
+        or no sizes in the index), the statistics are the same on every process and the mean
+        stays exact once reduced.
+        """
+        world_size = get_world_size()
+        if world_size == 1 or self.sizes is None or len(self.urls) < world_size:
+            return self.urls, self.num_samples
+        rank = get_rank()
+        return self.urls[rank::world_size], sum(self.sizes[rank::world_size])
+
+    @property
+    def random_flip_on_device(self) -> bool:
+        return self.mode == "train"
+
+
+def _as_split(src):
+    """node splitter keeping the shards as given, already split by `_eval_shards`"""
+    yield from src
@@ -32,14 +32,13 @@ class ModelUtils(BaseModelUtils):
         train_loss = 0.0
         train_correct = 0
         
-        for data, label in tqdm(train_dataset.data_loader):
+        for data, label in tqdm(train_dataset.prefetch(self.config.device)):
 
             data: Tensor
             label: Tensor
 
-            data, label = data.to(self.config.device), label.to(self.config.device)
             # clear the gradients of all optimized variables
-            self.optimizer.zero_grad()
+            self.optimizer.zero_grad(set_to_none=True)
             # forward pass: compute predicted outputs by passing inputs to the model
             output: Tensor = self.model(data)
             # calculate the batch loss
@@ -69,20 +68,19 @@ class ModelUtils(BaseModelUtils):
         eval_loss = 0.0
         correct = 0
 
-        for data, target in eval_dataset.data_loader:
-            data: Tensor
-            target: Tensor
+        with torch.inference_mode():
+            for data, target in eval_dataset.prefetch(self.config.device):
+                data: Tensor
+                target: Tensor
 
-            data, target = data.to(self.config.device), target.to(self.config.device)
+                output: Tensor = self.model(data)
 
-            output: Tensor = self.model(data)
+                loss = self.criterion.forward(output, target)
 
-            loss = self.criterion.forward(output, target)
+                eval_loss += loss.item() * data.size(0)
 
-            eval_loss += loss.item() * data.size(0)
-            
-            _, predicted = output.max(dim=1)
-            correct += (predicted == target).sum().item()
+                _, predicted = output.max(dim=1)
+                correct += (predicted == target).sum().item()
         
         eval_loss = eval_loss / len(eval_dataset)
         eval_acc = correct / len(eval_dataset)
@@ -100,37 +98,27 @@ class ModelUtils(BaseModelUtils):
         """
 
         categories = categories if categories is not None else list(range(self.config.num_class))
-        
-        def mapping(x):
-            return categories[x]
+        categories = np.asarray(categories)
+
+        label_col = np.empty(len(dataset), dtype=categories.dtype)
+        confidence_col = np.empty(len(dataset), dtype=float)
 
-        label_col = np.empty(len(dataset), dtype=type(categories[0]))
-        if confidence:
-            confidence_col = np.empty(len(dataset), dtype=float)
-            data = {"label": label_col, "confidence": confidence_col}
-        
-        else:
-            data = {"label": label_col}
-        
-        df = pd.DataFrame(data)
-        
         with torch.inference_mode():
-            for data, indexes in tqdm(dataset.data_loader):
+            for data, indexes in tqdm(dataset.prefetch(self.config.device)):
                 data: Tensor
                 indexes: Tensor
-                data = data.to(self.config.device)
                 output: Tensor = self.model(data)
 
                 output = F.softmax(output, dim=1)
 
                 confidences, indices = output.max(dim=1)
 
-                labels = list(map(mapping, indices.tolist()))
-                
-                indexes = indexes.tolist()
+                indexes = indexes.cpu().numpy()
 
-                df.loc[indexes, "label"] = labels
+                label_col[indexes] = np.take(categories, indices.cpu().numpy())
                 if confidence:
-                    df.loc[indexes, "confidence"] = confidences.tolist()
-        
-        return df
+                    confidence_col[indexes] = confidences.cpu().numpy()
+
+        if confidence:
+            return pd.DataFrame({"label": label_col, "confidence": confidence_col})
+        return pd.DataFrame({"label": label_col})
@@ -1,7 +1,9 @@
+import torch
 from imgclf.config import Config
 
 class NfnetConfig(Config):
     amp = False        # Enable automatic mixed precision
+    amp_dtype = torch.bfloat16 # dtype for autocast, GradScaler is only used for torch.float16
 
     # Model
     variant = 'F1'         # F0 - F7
@@ -10,8 +12,9 @@ class NfnetConfig(Config):
     stochdepth_rate = 0.25 # 0-1, the probability that a layer is dropped during one step
     alpha = 0.2            # Scaling factor at the end of each block
     se_ratio = 0.5         # Squeeze-Excite expansion ratio
-    use_fp16 = False       # Use 16bit floats, which lowers memory footprint. This currently sets
-                        # the complete model to FP16 (will be changed to match FP16 ops from paper)
+    channels_last = True   # Use NHWC memory format for the model and inputs (faster cuDNN convs)
+    compile = False        # Run the model through torch.compile (requires torch >= 2.0)
+    compile_mode = 'max-autotune' # mode for torch.compile
 
     # Training
     # batch_size = 64        # Batch size
@@ -23,6 +26,8 @@ class NfnetConfig(Config):
     momentum = 0.9         # Contribution of earlier gradient to gradient update
     weight_decay = 0.00002 # Factor with which weights are added to gradient
     nesterov = True        # Enable nesterov correction
+    accumulation_steps = 1 # Number of microbatches to accumulate gradients over before a step
+    label_smoothing = 0.1  # Label smoothing of the cross entropy loss
 
     do_clip = True         # Enable adaptive gradient clipping
     clipping = 0.1         # Adaptive gradient clipping parameter
@@ -1,8 +1,29 @@
 from typing import OrderedDict
 import torch
-from torch import nn
+from torch import nn, Tensor
 import numpy as np
-from nfnets import NFNet # pylint: disable=import-error
+from nfnets import NFNet, WSConv2D # pylint: disable=import-error
+
+WS_EPS = 1e-4
+"""eps of the weight standardization, same as `nfnets.WSConv2D`"""
+
+@torch.jit.script
+def standardize_weight(weight: Tensor, gain: Tensor, fan_in: float, eps: float) -> Tensor:
+    """(weight - mean) * rsqrt(max(var * fan_in, eps)) * gain over the fan-in dims, where the
+    per output channel statistics are taken in one pass and the rest is fused into a single
+    elementwise kernel over the weight
+    """
+    var, mean = torch.var_mean(weight, dim=[1, 2, 3], unbiased=True, keepdim=True)
+    scale = torch.rsqrt(torch.clamp(var * fan_in, min=eps)) * gain.view_as(var)
+    return (weight - mean) * scale
+
+
+class FusedWSConv2D(WSConv2D):
+    """`WSConv2D` with the weight standardization done by the scripted `standardize_weight`"""
+
+    def standardized_weights(self):
+        return standardize_weight(self.weight, self.gain, float(self.weight[0].numel()), WS_EPS)
+
 
 class MyNfnet(NFNet):
     def __init__(self, **kwargs):
@@ -10,6 +31,11 @@ class MyNfnet(NFNet):
         kwargs["num_classes"] = 1000
         super().__init__(**kwargs)
         self.fc = nn.Linear(1000, num_classes)
+
+        # same parameters and state_dict, only the forward of the standardization changes
+        for module in self.modules():
+            if type(module) is WSConv2D: # pylint: disable=unidiomatic-typecheck
+                module.__class__ = FusedWSConv2D
         return
 
     def forward(self, x):
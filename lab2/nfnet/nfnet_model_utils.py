@@ -1,19 +1,39 @@
-from typing import Tuple
+import warnings
+from typing import Optional, Tuple
+from contextlib import nullcontext
 import torch
 from torch import Tensor
 from torch.cuda import amp
 from torch.nn import functional as F
+from torch import distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
 from nfnets import SGD_AGC, pretrained_nfnet, NFNet # pylint: disable=import-error
+from imgclf.base.distributed import is_distributed, is_main_process
+from imgclf.base.logger import Logger, NullLogger
 from imgclf.base.model_utils.base_model_utils import BaseModelUtils
+from imgclf.base.model_utils.history import Stat
 from imgclf.dataset import Dataset
 from .model import MyNfnet
 from .config import NfnetConfig
 
 class NfnetModelUtils(BaseModelUtils):
 
+    NAN_CHECK_STEPS = 50
+    """check whether the loss is nan every `NAN_CHECK_STEPS` steps (each check is a sync)"""
+
+    net: torch.nn.Module
+    """`model` as it runs forward for training, i.e. wrapped by DDP when the process group is
+    initialized (e.g. launched by torchrun) and compiled if `config.compile`. `model` itself
+    stays unwrapped for checkpoints and the optimizer."""
+
+    eval_net: torch.nn.Module
+    """`model` as it runs forward for evaluation and inference, i.e. compiled if `config.compile`
+    but never wrapped by DDP: there are no gradients to reduce and the processes may run a
+    different number of batches (see `Dataset.data_loader`)."""
+
     def __init__(
         self,
         model: torch.nn.modules,
@@ -24,7 +44,11 @@ class NfnetModelUtils(BaseModelUtils):
         history_utils,
         logger,
     ):
-        self.scaler = amp.GradScaler()
+        self._check_amp_dtype(config)
+        # loss scaling is only needed for float16, bfloat16 has the range of float32
+        self.scaler = (
+            amp.GradScaler() if config["amp"] and config["amp_dtype"] == torch.float16 else None
+        )
         super().__init__(
             model = model,
             config = config,
@@ -34,11 +58,92 @@ class NfnetModelUtils(BaseModelUtils):
             history_utils = history_utils,
             logger = logger,
         )
+        self.net = self.model
+        self.eval_net = self.model
+        self.ddp = None
+        if is_distributed():
+            self.ddp = DistributedDataParallel(
+                self.model,
+                device_ids=[config.device],
+                gradient_as_bucket_view=True,
+            )
+            self.net = self.ddp
+
+        if config.compile:
+            assert hasattr(torch, "compile"), "torch.compile requires torch >= 2.0"
+            self.net = torch.compile(self.net, mode=config.compile_mode)
+            self.eval_net = (
+                self.net if self.ddp is None
+                else torch.compile(self.model, mode=config.compile_mode)
+            )
+        return
+
+    def _no_sync(self, sync: bool):
+        """skip the gradients all-reduce of DDP for the microbatches not followed by a step"""
+        if sync or self.ddp is None:
+            return nullcontext()
+        return self.ddp.no_sync()
+
+    def _reduce(self, *values: float):
+        """sum the values over all processes"""
+        if not is_distributed():
+            return values
+        tensor = torch.tensor(values, dtype=torch.float64, device=self.config.device)
+        dist.all_reduce(tensor)
+        return tensor.tolist()
+
+    @staticmethod
+    def _new_root(config: NfnetConfig) -> str:
+        if not is_distributed():
+            return BaseModelUtils._new_root(config)
+        # a single dir for all the processes, created and named by rank 0
+        root = [BaseModelUtils._new_root(config) if is_main_process() else None]
+        dist.broadcast_object_list(root, src=0)
+        return root[0]
+
+    @staticmethod
+    def _get_logger(root: str) -> Logger:
+        # only rank 0 writes the log
+        return BaseModelUtils._get_logger(root) if is_main_process() else NullLogger()
+
+    def _save(self, cur_epoch: int, stat: Stat) -> Optional[str]:
+        """save a checkpoint on rank 0, None on the other processes"""
+        if not is_main_process():
+            return None
+        return super()._save(cur_epoch, stat)
+
+    def _log_history(self, stat: Stat) -> str:
+        # only rank 0 writes the history, the other processes return the same path
+        if not is_main_process():
+            return self.history_utils.path
+        return super()._log_history(stat)
+
+    @staticmethod
+    def _check_amp_dtype(config: NfnetConfig):
+        """fall back to float16 (with loss scaling) where bfloat16 is not supported (< sm80)"""
+        if (
+            config["amp"] and config["amp_dtype"] == torch.bfloat16
+            and not torch.cuda.is_bf16_supported()
+        ):
+            warnings.warn("bfloat16 is not supported by the device, autocast to float16 instead")
+            config.amp_dtype = torch.float16
         return
+
+    @staticmethod
+    def _autocast(config: NfnetConfig):
+        # torch 1.10 checks the dtype even with enabled=False, so do not build it at all
+        if not config["amp"]:
+            return nullcontext()
+        return amp.autocast(dtype=config["amp_dtype"])
+
+    @property
+    def _memory_format(self):
+        return torch.channels_last if self.config.channels_last else None
     
     @staticmethod
     def _get_criterion(config):
-        return torch.nn.CrossEntropyLoss()
+        """no criterion module, the loss is `F.cross_entropy` called directly"""
+        return None
 
     @staticmethod
     def _get_optimizer(model: NFNet, config: NfnetConfig):
@@ -76,8 +181,60 @@ class NfnetModelUtils(BaseModelUtils):
             activation=config["activation"]
         )
         model.to(config.device)
+        if config.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        # the input shape is fixed, let cuDNN benchmark and cache the fastest conv algorithms
+        torch.backends.cudnn.benchmark = True
         return model
     
+    @classmethod
+    def find_max_batch_size(cls, config: NfnetConfig, start: int = 8, limit: int = 1024) -> int:
+        """double the batch size from `start` until a training step on random inputs runs
+        out of memory, then back off one step: the real training loop also holds a prefetched
+        batch on the device, the DDP buckets and, with `config.compile`, the compiled graphs.
+
+        Returns:
+            int: half the largest batch size that fits (but at least `start`),
+                None if even `start` does not fit
+        """
+        cls._check_amp_dtype(config)
+        model = cls.init_model(config)
+        model.train()
+        optimizer = cls._get_optimizer(model, config)
+        memory_format = torch.channels_last if config.channels_last else torch.contiguous_format
+
+        def train_step(batch_size: int):
+            inputs = torch.rand(batch_size, 3, *config.img_size, device=config.device)
+            inputs = inputs.contiguous(memory_format=memory_format)
+            targets = torch.randint(config.num_class, (batch_size,), device=config.device)
+            with cls._autocast(config):
+                loss: Tensor = F.cross_entropy(
+                    model(inputs), targets, label_smoothing=config.label_smoothing
+                )
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+            torch.cuda.synchronize(config.device)
+            return
+
+        max_batch_size = None
+        batch_size = start
+        while batch_size <= limit:
+            try:
+                train_step(batch_size)
+            except RuntimeError as err:
+                if "out of memory" not in str(err):
+                    raise
+                break
+            max_batch_size = batch_size
+            batch_size *= 2
+
+        del model, optimizer
+        torch.cuda.empty_cache()
+        if max_batch_size is None:
+            return None
+        return max(max_batch_size // 2, start)
+
     @classmethod
     def start_new_training_from_pretrained(cls, pretrained_path: str, config: NfnetConfig):
 
@@ -92,40 +249,60 @@ class NfnetModelUtils(BaseModelUtils):
     
     def _train_epoch(self, train_dataset: Dataset) -> Tuple[float, float]:
         self.model.train()
-        dataloader = train_dataset.data_loader
-        running_loss = 0.0
-        correct_labels = 0
+        # accumulated on the device to avoid a sync every step
+        running_loss = torch.zeros((), device=self.config.device)
+        correct_labels = torch.zeros((), dtype=torch.long, device=self.config.device)
+        num_samples = 0
         is_nan = False
-        for inputs, targets in tqdm(dataloader):
+        accumulation_steps = self.config.accumulation_steps
+        prefetcher = train_dataset.prefetch(self.config.device, self._memory_format)
+        num_batches = len(prefetcher)
+        self.optimizer.zero_grad(set_to_none=True)
+        for step, (inputs, targets) in enumerate(tqdm(prefetcher)):
 
-            inputs: Tensor = inputs.half().to(self.config.device)\
-                if self.config["use_fp16"] else inputs.to(self.config.device)
-            
-            targets: Tensor = targets.to(self.config.device)
+            inputs: Tensor
+            targets: Tensor
 
-            self.optimizer.zero_grad()
+            # only sync (all-reduce) and step on the last microbatch of the accumulation
+            sync = (step + 1) % accumulation_steps == 0 or step + 1 == num_batches
+            # the last group of the epoch may have fewer microbatches
+            group_start = step - step % accumulation_steps
+            group_size = min(accumulation_steps, num_batches - group_start)
 
-            with amp.autocast(enabled=self.config["amp"]):
-                output = self.model(inputs)
-            loss: Tensor = self.criterion(output, targets)
-            
-            # Gradient scaling
-            # https://www.youtube.com/watch?v=OqCrNkjN_PM
-            self.scaler.scale(loss).backward()
-            self.scaler.step(self.optimizer)
-            self.scaler.update()
-
-            tem = loss.item() * inputs.size(0)
-            if np.isnan(tem):
-                if not is_nan:
-                    is_nan = True
-                    print("nan!")
-            elif is_nan:
-                print("no longer nan")
-                is_nan = False
-            running_loss += tem
-            _, predicted = torch.max(output, 1)
-            correct_labels += (predicted == targets).sum().item()
+            with self._no_sync(sync):
+                with self._autocast(self.config):
+                    output = self.net(inputs)
+                    loss: Tensor = F.cross_entropy(
+                        output, targets, label_smoothing=self.config.label_smoothing
+                    )
+
+                if self.scaler is not None:
+                    # Gradient scaling
+                    # https://www.youtube.com/watch?v=OqCrNkjN_PM
+                    self.scaler.scale(loss / group_size).backward()
+                else:
+                    (loss / group_size).backward()
+
+            if sync:
+                if self.scaler is not None:
+                    self.scaler.step(self.optimizer)
+                    self.scaler.update()
+                else:
+                    self.optimizer.step()
+                self.optimizer.zero_grad(set_to_none=True)
+
+            running_loss.add_(loss.detach() * inputs.size(0))
+            correct_labels.add_((output.argmax(dim=1) == targets).sum())
+            num_samples += inputs.size(0)
+
+            if step % self.NAN_CHECK_STEPS == 0:
+                if torch.isnan(loss).any():
+                    if not is_nan:
+                        is_nan = True
+                        print("nan!")
+                elif is_nan:
+                    print("no longer nan")
+                    is_nan = False
 
         # epoch_padding = int(math.log10(epochs) + 1)
         # batch_padding = int(math.log10(len(dataloader.dataset)) + 1)
@@ -134,29 +311,41 @@ class NfnetModelUtils(BaseModelUtils):
         #     f"\tLoss {running_loss / (step+1):6.4f}"
         #     f"\tAcc {100.0*correct_labels/processed_imgs:5.3f}%\t",
         # sep=' ', end='', flush=True)
-        running_loss = running_loss / len(train_dataset)
-        train_acc = correct_labels / len(train_dataset)
+        running_loss, correct_labels, num_samples = self._reduce(
+            running_loss.item(), correct_labels.item(), num_samples
+        )
+        running_loss = running_loss / num_samples
+        train_acc = correct_labels / num_samples
         return running_loss, train_acc
     
     def _eval_epoch(self, eval_dataset: Dataset) -> Tuple[float, float]:
         self.model.eval()
 
-        correct_labels = 0
-        eval_loss = 0.0
-        for inputs, targets in tqdm(eval_dataset.data_loader):
-            with torch.no_grad():
-                inputs: Tensor = inputs.to(self.config.device)
-                targets: Tensor = targets.to(self.config.device)
-
-                output = self.model(inputs).type(torch.float32)
+        prefetcher = eval_dataset.prefetch(self.config.device, self._memory_format)
+        with torch.inference_mode():
+            correct_labels = torch.zeros((), dtype=torch.long, device=self.config.device)
+            eval_loss = torch.zeros((), device=self.config.device)
+            num_samples = 0
+            for inputs, targets in tqdm(prefetcher):
+                inputs: Tensor
+                targets: Tensor
 
-                loss: Tensor = self.criterion.forward(output, targets)
-                eval_loss += loss.item() * inputs.size(0)
-                _, predicted = torch.max(output, 1)
-                correct_labels += (predicted == targets).sum().item()
+                with self._autocast(self.config):
+                    output = self.eval_net(inputs)
+                    # autocast runs cross entropy in float32 whatever the dtype of output
+                    loss: Tensor = F.cross_entropy(
+                        output, targets,
+                        label_smoothing=self.config.label_smoothing, reduction="sum",
+                    )
+                eval_loss.add_(loss)
+                correct_labels.add_((output.argmax(dim=1) == targets).sum())
+                num_samples += inputs.size(0)
 
-        eval_loss = eval_loss / len(eval_dataset)
-        eval_acc = correct_labels / len(eval_dataset)
+        eval_loss, correct_labels, num_samples = self._reduce(
+            eval_loss.item(), correct_labels.item(), num_samples
+        )
+        eval_loss = eval_loss / num_samples
+        eval_acc = correct_labels / num_samples
         return eval_loss, eval_acc
 
     def inference(self, dataset: Dataset, categories: list = None, confidence: bool = True):
@@ -170,37 +359,30 @@ class NfnetModelUtils(BaseModelUtils):
         """
 
         categories = categories if categories is not None else list(range(self.config.num_class))
-        
-        def mapping(x):
-            return categories[x]
+        categories = np.asarray(categories)
+
+        label_col = np.empty(len(dataset), dtype=categories.dtype)
+        confidence_col = np.empty(len(dataset), dtype=float)
 
-        label_col = np.empty(len(dataset), dtype=type(categories[0]))
-        if confidence:
-            confidence_col = np.empty(len(dataset), dtype=float)
-            data = {"label": label_col, "confidence": confidence_col}
-        
-        else:
-            data = {"label": label_col}
-        
-        df = pd.DataFrame(data)
-        
         with torch.inference_mode():
-            for data, indexes in tqdm(dataset.data_loader):
+            for data, indexes in tqdm(dataset.prefetch(self.config.device, self._memory_format)):
                 data: Tensor
                 indexes: Tensor
-                data = data.to(self.config.device)
-                output: Tensor = self.model(data)
-
-                output = F.softmax(output, dim=1)
+                with self._autocast(self.config):
+                    output: Tensor = self.eval_net(data)
 
-                confidences, indices = output.max(dim=1)
+                # softmax does not change the argmax, only the confidence needs it:
+                # max(softmax(x)) = exp(max(x) - logsumexp(x))
+                output = output.float()
+                indices = output.argmax(dim=1)
+                confidences = (output.amax(dim=1) - output.logsumexp(dim=1)).exp()
 
-                labels = list(map(mapping, indices.tolist()))
-                
-                indexes = indexes.tolist()
+                indexes = indexes.cpu().numpy()
 
-                df.loc[indexes, "label"] = labels
+                label_col[indexes] = np.take(categories, indices.cpu().numpy())
                 if confidence:
-                    df.loc[indexes, "confidence"] = confidences.tolist()
-        
-        return df
+                    confidence_col[indexes] = confidences.cpu().numpy()
+
+        if confidence:
+            return pd.DataFrame({"label": label_col, "confidence": confidence_col})
+        return pd.DataFrame({"label": label_col})
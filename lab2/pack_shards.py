@@ -0,0 +1,87 @@
+"""
+pack the images listed in a csv (columns 'img' and 'label', e.g. set.csv of donf.py) into
+WebDataset tar shards of ~1 GB, split into train and valid the same way as donf.py:
+    python pack_shards.py set.csv shards
+
+output:
+    shards/train/shard-000000.tar, ..., shards/train/index.json
+    shards/valid/shard-000000.tar, ..., shards/valid/index.json
+
+then train with:
+    python donf.py new -e 10 -b 8 --shards=shards
+
+requires webdataset (pip install webdataset)
+"""
+import os
+import json
+import hashlib
+from collections import Counter
+import argparse
+import numpy as np
+import pandas as pd
+import webdataset as wds
+from tqdm import tqdm
+from imgclf.config import Config
+from imgclf.dataset import Dataset
+from imgclf.dataset.shard_dataset import INDEX_NAME
+
+SHARD_PATTERN = "shard-%06d.tar"
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv", type=str, metavar="<path to csv>")
+    parser.add_argument("out_dir", type=str, metavar="<dir to output shards>")
+    parser.add_argument("--train-ratio", type=float, default=0.8)
+    parser.add_argument("--shard-size", type=float, default=1e9, metavar="<bytes per shard>")
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.csv, usecols=["img", "label"], dtype={"img": str, "label": np.int64})
+    train_set, valid_set = Dataset.train_test_split(df, train_ratio=args.train_ratio,
+                                                    config=Config())
+    # the train split keeps the shuffled order of train_test_split: the paths are
+    # <category>/<file>, so sorting them would fill each shard with one or two classes only,
+    # which the shuffle buffer of ShardDataset cannot mix
+    pack(train_set.df, os.path.join(args.out_dir, "train"), args.shard_size)
+    pack(valid_set.df, os.path.join(args.out_dir, "valid"), args.shard_size, sort=True)
+    return
+
+def pack(df: pd.DataFrame, out_dir: str, shard_size: float = 1e9, sort: bool = False):
+    """write the rows of df into tar shards
+
+    Args:
+        df (pd.DataFrame): same as `Dataset.__init__`
+        out_dir (str): dir to output the shards and index.json
+        shard_size (float): max bytes per shard. Defaults to 1e9.
+        sort (bool): sort the rows by path, for sequential reads on disk. Only for sets whose
+            order does not matter (e.g. eval). Defaults to False (keep the order of df).
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    if sort:
+        df = df.sort_values("img")
+    pattern = os.path.join(out_dir, SHARD_PATTERN)
+    sizes = Counter()
+
+    with wds.ShardWriter(pattern, maxsize=int(shard_size)) as sink:
+        for imgpath, label in tqdm(zip(df["img"], df["label"]), total=len(df)):
+            with open(imgpath, "rb") as fin:
+                data = fin.read()
+            sink.write({
+                "__key__": hashlib.sha1(imgpath.encode("utf-8")).hexdigest(),
+                "jpg": data,
+                "cls": int(label),
+            })
+            # the shard being written is the last one opened
+            sizes[sink.shard - 1] += 1
+        num_shards = sink.shard
+
+    index = {
+        "shards": [SHARD_PATTERN % i for i in range(num_shards)],
+        "sizes": [sizes[i] for i in range(num_shards)],
+        "num_samples": len(df),
+    }
+    with open(os.path.join(out_dir, INDEX_NAME), "w", encoding="utf-8") as fout:
+        json.dump(index, fout, indent=4)
+    return
+
+if __name__ == "__main__":
+    main()
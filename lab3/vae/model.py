@@ -23,6 +23,15 @@ class ModelConfig(BaseConfig):
     deep: bool = True
     preprocessing: bool = True
 
+def upsample2x(in_channels: int, out_channels: int):
+    """x2 upsampling with conv + PixelShuffle, replaces ConvTranspose2d(kernel_size=4, stride=2,
+    padding=1) without its checkerboard artifacts and strided backward
+    """
+    return nn.Sequential(
+        nn.Conv2d(in_channels, out_channels * 4, kernel_size=3, padding=1),
+        nn.PixelShuffle(2),
+    )
+
 class Encoder(nn.Module):
     def __init__(self, config: ModelConfig):
         super().__init__()
@@ -73,15 +82,14 @@ class Decoder(nn.Module):
                 nn.Linear(dim // 2, dim),
                 nn.ReLU(inplace=True),
             )
-            self.conv3 = nn.ConvTranspose2d(c*4, c*2, kernel_size=4, stride=2, padding=1)
+            self.conv3 = upsample2x(c*4, c*2)
         else:
             self.fc = nn.Sequential(
                 nn.Linear(config.latent_dims, dim),
                 nn.ReLU(inplace=True),
             )
-        self.conv2 = nn.ConvTranspose2d(c*2, c, kernel_size=4, stride=2, padding=1)
-        self.conv1 = nn.ConvTranspose2d(c, config.input_shape[-1],
-                                        kernel_size=4, stride=2, padding=1)
+        self.conv2 = upsample2x(c*2, c)
+        self.conv1 = upsample2x(c, config.input_shape[-1])
             
     def forward(self, x: Tensor):
         x = self.fc(x)
@@ -97,10 +105,8 @@ class Decoder(nn.Module):
         x = F.relu(self.conv2(x))
         x = self.conv1(x)
         # # b x c x w x h
-        if self.config.preprocessing:
-            x = torch.softmax(x, dim=1)
-        else:
-            x = torch.sigmoid(x)
+        # logits of independent Bernoulli per element, sigmoid is fused into the loss
+        # (see VariationalAutoencoder.criterion) and left to the caller otherwise
         return x
     
 class VariationalAutoencoder(nn.Module):
@@ -124,19 +130,19 @@ class VariationalAutoencoder(nn.Module):
             return eps.mul(std).add_(mu)
         return mu
     
-    def criterion(self, x: Tensor, recon_x: Tensor, mu: Tensor, logvar: Tensor):
+    def criterion(self, x: Tensor, recon_logits: Tensor, mu: Tensor, logvar: Tensor):
         """_summary_
 
         Args:
             x (Tensor): _description_
-            recon_x (Tensor): _description_
+            recon_logits (Tensor): output of the decoder, i.e. before sigmoid
             mu (Tensor): _description_
             logvar (Tensor): _description_
 
         Returns:
             overall_loss, recon_loss, kldivergence
         """
-        # recon_x is the probability of a multivariate Bernoulli distribution p.
+        # sigmoid(recon_logits) is the probability of a multivariate Bernoulli distribution p.
         # -log(p(x)) is then the pixel-wise binary cross-entropy.
         # Averaging or not averaging the binary cross-entropy over all pixels here
         # is a subtle detail with big effect on training, since it changes the weight
@@ -145,14 +151,16 @@ class VariationalAutoencoder(nn.Module):
         # but averaging makes the weight of the other loss term independent of the image resolution.
         # dim = self.config.input_shape[0] ** 2
         # x: b x c x w x h
-        recon_loss = F.binary_cross_entropy(recon_x, x, reduction="sum")
+        recon_loss = F.binary_cross_entropy_with_logits(
+            recon_logits.float().flatten(1), x.float().flatten(1), reduction="sum"
+        )
         # recon_loss = F.mse_loss(recon_x, x, reduction="sum")
         #MSEloss
         # KL-divergence between the prior distribution over latent vectors
         # (the one we are going to sample from when generating new images)
         # and the distribution estimated by the generator for the given image.
-        tem = 1 + logvar - mu.pow(2) - logvar.exp()
-        kldivergence = -1 * torch.sum(tem)
+        # -(1 + logvar - mu^2 - exp(logvar)), summed in a single reduction
+        kldivergence = torch.sum(mu.pow(2).add_(logvar.exp()).sub_(logvar).sub_(1))
 
         if self.config.variational_beta:
             overall_loss = recon_loss + kldivergence * self.config.variational_beta
@@ -82,7 +82,7 @@ class ModelUtils(BaseModelUtils):
             img: Tensor
             if self.config.preprocessing:
                 img = self.preprocessor.forward(img)
-            img = img.to(self.config.device)
+            img = img.to(self.config.device, non_blocking=True)
 
             # vae reconstruction
             outputs: Tensor = self.model(img)
@@ -96,7 +96,7 @@ class ModelUtils(BaseModelUtils):
             # self.logger.file.log(str(outputs[0][0]))
             
             # backpropagation
-            self.optimizer.zero_grad()
+            self.optimizer.zero_grad(set_to_none=True)
             overall_loss.backward()
             
             # one step of the optmizer (using the gradients from backpropagation)
@@ -130,7 +130,7 @@ class ModelUtils(BaseModelUtils):
             if self.config.preprocessing:
                 img = self.preprocessor.forward(img)
             
-            img = img.to(self.config.device)
+            img = img.to(self.config.device, non_blocking=True)
 
             # vae reconstruction
             outputs: Tensor = self.model(img)
@@ -182,7 +182,7 @@ class ModelUtils(BaseModelUtils):
         with torch.no_grad():
             images: Tensor = images.to(self.config.device)
             images, _, _ = self.model(images)
-            images = images.cpu()
+            images = torch.sigmoid(images).cpu()
             images = to_img(images)
             if self.config.preprocessing:
                 show(self.preprocessor.inference(images), "reconstructional")
@@ -196,7 +196,7 @@ class ModelUtils(BaseModelUtils):
                 # reconstruct images from the latent vectors
                 latents = latents.to(self.config.device)
                 image_recon: Tensor = self.model.decoder(latents)
-                image_recon = image_recon.cpu()
+                image_recon = torch.sigmoid(image_recon).cpu()
                 fig, ax = plt.subplots(figsize=(10, 10))
                 images = image_recon.data[:(SIZE ** 2)]
                 if self.config.preprocessing: